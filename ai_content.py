@@ -1,54 +1,95 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import logging
 import os
+import queue
+import re
+import tempfile
+import threading
 import google.generativeai as genai
 from dotenv import load_dotenv
+from google.api_core.exceptions import ServerError, TooManyRequests
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+log = logging.getLogger(__name__)
 
 # --- Initialization ---
 # Load environment variables from .env file
 load_dotenv()
 
+MODEL_NAME = 'gemini-1.5-flash'
+
+# Explanations are cached on disk so identical files are never sent twice.
+# Set AI_CACHE_DIR to an empty string to disable the disk cache. Once it grows
+# past AI_CACHE_MAX_MB, the least recently used entries are deleted.
+AI_CACHE_DIR = os.getenv("AI_CACHE_DIR", "/tmp/ai_cache")
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_MB", "512")) * 1024 * 1024
+# The most recently used explanations are also kept in memory, in front of
+# the disk cache. Only the key digest and the text are held.
+MEMORY_CACHE_SIZE = 1024
+
+
+# Stand-ins used when the Gemini client can't be initialized
+class _Stub:
+    """Stands in for a Gemini response when the AI is unavailable."""
+    text = "ERROR: Gemini AI Client failed to initialize. Check your API key."
+
+
+class DummyModel:
+    def generate_content(self, *args, **kwargs):
+        return _Stub()
+
+    async def generate_content_async(self, *args, **kwargs):
+        return _Stub()
+
+
 # Configure the Gemini API client
 try:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("GEMINI_API_KEY not found in .env file.")
-    genai.configure(api_key=api_key)
+    # GEMINI_TRANSPORT can be set to 'rest' or 'grpc' (the default) to pick
+    # how the client talks to the API.
+    genai.configure(api_key=api_key, transport=os.getenv("GEMINI_TRANSPORT") or None)
     
     # Create the model instance
     # We use 'gemini-1.5-flash' for its speed and large context window.
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    print("Gemini AI Content Generator Initialized Successfully.")
+    model = genai.GenerativeModel(MODEL_NAME)
+    log.info("Gemini AI Content Generator Initialized Successfully.")
 
 except Exception as e:
-    print(f"Error initializing Gemini AI: {e}")
+    log.error("Error initializing Gemini AI: %s", e)
     # If the AI fails to init, we create a dummy model that returns errors
     # This prevents the whole application from crashing if the API key is missing.
-    class DummyModel:
-        def generate_content(self, *args, **kwargs):
-            return "ERROR: Gemini AI Client failed to initialize. Check your API key."
     model = DummyModel()
 
 
-# --- Real AI Functions (will be populated next) ---
+# Callers can check this to skip the AI stage entirely instead of making
+# one failing call per file.
+AI_AVAILABLE = not isinstance(model, DummyModel)
 
-def generate_file_explanation(file_content, file_path):
-    """
-    Analyzes a single code file using the Gemini AI and returns a
-    Markdown-formatted explanation.
-    """
-    filename = os.path.basename(file_path)
-    print(f"REAL AI: Generating explanation for {filename}...")
 
-    # This is the prompt. It's carefully structured to guide the AI.
-    prompt = f"""
+# --- Prompt Templates ---
+# Anything past this many characters of a file adds tokens (and memory)
+# without making the explanation noticeably better, so it is cut off.
+MAX_CONTENT_CHARS = 64_000
+TRUNCATION_MARKER = "\n...[truncated]...\n"
+
+# This is the prompt. It's carefully structured to guide the AI.
+# Only the path and the content vary, so the static prose is kept in fixed
+# pieces and joined per call.
+FILE_PROMPT_PREFIX = """
     You are an expert software developer and a skilled technical writer acting as an onboarding assistant for a new developer.
     Your task is to provide a clear, concise, and beginner-friendly explanation for a given code file.
 
-    The file is located at the path: `{file_path}`
+    The file is located at the path: `"""
+FILE_PROMPT_MID = """`
     The content of the file is:
     ```
-    {file_content}
-    ```
-
+    """
+FILE_PROMPT_INSTRUCTIONS = """
     Please generate documentation in Markdown format that includes the following sections:
 
     ### 1. File Overview
@@ -71,16 +112,386 @@ def generate_file_explanation(file_content, file_path):
 
     Keep the tone helpful and educational. Assume the reader is a competent developer but is completely new to this specific codebase.
     """
+FILE_PROMPT_SUFFIX = "\n    ```\n" + FILE_PROMPT_INSTRUCTIONS
+
+# Small files are explained several at a time in a single request, since
+# for them the round-trip costs more than the generation itself. A batch is
+# capped both by file count and by total content size.
+BATCH_MAX_CHARS = 4000
+BATCH_SIZE = 16
+BATCH_BUDGET_CHARS = 30_000
+# Each explanation in a batched reply starts with a line naming its file, so
+# the reply can be matched back to the files by path rather than by position.
+BATCH_SECTION_RE = re.compile(r"^===EXPLAIN: (.+?)===[ \t]*$", re.MULTILINE)
+BATCH_PROMPT_PREFIX = """
+    You are an expert software developer and a skilled technical writer acting as an onboarding assistant for a new developer.
+    Your task is to provide a clear, concise, and beginner-friendly explanation for each of the code files below.
+"""
+BATCH_PROMPT_SUFFIX = f"""
+    Explain each file separately. For each file:
+{FILE_PROMPT_INSTRUCTIONS}
+    Start each explanation with a line containing only ===EXPLAIN: <path>===, where <path> is the file's path exactly as given in its ===FILE: <path>=== line.
+    Do not repeat the file name as a heading; after that line, start directly with the "1. File Overview" section.
+    Do not use the ===EXPLAIN: marker anywhere else.
+    """
+
+
+# --- Response Cache ---
+
+_memory_cache = collections.OrderedDict()
+_memory_lock = threading.Lock()
+
 
+def _cache_key(prompt):
+    return hashlib.sha256(f"{MODEL_NAME}\n{prompt}".encode('utf-8')).hexdigest()
+
+
+def _cache_path(key):
+    """Returns the on-disk location of the cached response for a cache key."""
+    return os.path.join(AI_CACHE_DIR, key[:2], key)
+
+
+def _remember(key, text):
+    with _memory_lock:
+        _memory_cache[key] = text
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _cache_get(prompt):
+    key = _cache_key(prompt)
+    with _memory_lock:
+        text = _memory_cache.get(key)
+        if text is not None:
+            _memory_cache.move_to_end(key)
+            return text
+    if not AI_CACHE_DIR:
+        return None
+    path = _cache_path(key)
     try:
-        # Make the actual API call
-        response = model.generate_content(prompt)
-        # Prepend a title to the AI's response
-        return f"# Explanation for `{filename}`\n\n" + response.text
-    except Exception as e:
-        print(f"Error generating content for {filename}: {e}")
-        # Return a helpful error message to be included in the documentation
-        return f"# Error Analyzing `{filename}`\n\nAn error occurred while communicating with the AI model: {e}"
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        return None
+    try:
+        # The modification time doubles as the last-used time for pruning
+        os.utime(path)
+    except OSError:
+        pass
+    _remember(key, text)
+    return text
+
+
+def _cache_put(prompt, text):
+    """Stores a response atomically, so readers never see a partial file."""
+    # Dummy model output and failed calls are just error text; never keep those.
+    if not AI_AVAILABLE or _is_error_text(text):
+        return
+    key = _cache_key(prompt)
+    _remember(key, text)
+    if not AI_CACHE_DIR:
+        return
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("Could not write AI cache entry: %s", e)
+
+
+def _prune_cache():
+    """Deletes the least recently used cache entries until the cache fits in AI_CACHE_MAX_BYTES."""
+    if not AI_CACHE_DIR:
+        return
+    entries = []
+    total = 0
+    try:
+        with os.scandir(AI_CACHE_DIR) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+                        total += st.st_size
+    except OSError:
+        return
+    if total <= AI_CACHE_MAX_BYTES:
+        return
+
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            # Another worker may have pruned it already
+            continue
+        total -= size
+        removed += 1
+        if total <= AI_CACHE_MAX_BYTES:
+            break
+    log.info("Pruned %s entries from the AI cache.", removed)
+
+
+def _is_error_text(text):
+    """True if an explanation is an error message rather than AI output."""
+    return text.startswith("ERROR:") or text.startswith("# Error Analyzing `")
+
+
+def disk_cached(func):
+    """
+    Caches the text returned by an async (file_content, file_path, ...)
+    explanation function on disk, keyed by the SHA-256 of the model name
+    and prompt.
+    """
+    @functools.wraps(func)
+    async def wrapper(file_content, file_path, *args, **kwargs):
+        prompt = _build_file_prompt(file_content, file_path)
+        cached = _cache_get(prompt)
+        if cached is not None:
+            return cached
+        text = await func(file_content, file_path, *args, **kwargs)
+        _cache_put(prompt, text)
+        return text
+    return wrapper
+
+
+# --- API Calls ---
+# Rate limiting (429) and server errors (5xx) are usually transient, so those
+# are retried with exponential backoff. Anything else (bad request, auth)
+# fails straight away.
+_retry_transient = retry(
+    retry=retry_if_exception_type((TooManyRequests, ServerError)),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+@_retry_transient
+def _generate_content(prompt, **kwargs):
+    return model.generate_content(prompt, **kwargs)
+
+
+@_retry_transient
+async def _generate_content_async(prompt, **kwargs):
+    return await model.generate_content_async(prompt, **kwargs)
+
+
+# --- Real AI Functions (will be populated next) ---
+
+@disk_cached
+async def generate_file_explanation_async(file_content, file_path, semaphore):
+    """
+    Analyzes a single code file using the Gemini AI and returns a
+    Markdown-formatted explanation. The semaphore caps how many requests
+    are in flight against the Gemini API at once.
+    """
+    filename = os.path.basename(file_path)
+    prompt = _build_file_prompt(file_content, file_path)
+
+    async with semaphore:
+        log.info("REAL AI: Generating explanation for %s...", filename)
+        try:
+            # Make the actual API call
+            response = await _generate_content_async(prompt)
+            # Prepend a title to the AI's response
+            return f"# Explanation for `{filename}`\n\n" + response.text
+        except Exception as e:
+            log.error("Error generating content for %s: %s", filename, e)
+            # Return a helpful error message to be included in the documentation
+            return _error_document(filename, e)
+
+
+async def generate_batch_explanations_async(files, semaphore):
+    """
+    Explains several small (file_content, file_path) files with a single
+    Gemini request and returns their explanations in order. If the call
+    fails or the reply can't be split back into one part per file, each
+    file is explained on its own instead.
+    """
+    async with semaphore:
+        log.info("REAL AI: Generating explanations for a batch of %s files...", len(files))
+        try:
+            response = await _generate_content_async(_build_batch_prompt(files))
+            explanations = _split_batch_response(response.text, files)
+        except Exception as e:
+            log.error("Error generating content for batch: %s", e)
+            explanations = None
+
+    if explanations is None:
+        return await asyncio.gather(*(
+            generate_file_explanation_async(file_content, file_path, semaphore)
+            for file_content, file_path in files
+        ))
+    for (file_content, file_path), explanation in zip(files, explanations):
+        _cache_put(_build_file_prompt(file_content, file_path), explanation)
+    return explanations
+
+
+def _pack_batches(indices, files):
+    """
+    Packs the given file indices into batches of at most BATCH_SIZE files
+    and BATCH_BUDGET_CHARS characters of content, in order.
+    """
+    batches = []
+    batch, batch_chars = [], 0
+    for index in indices:
+        chars = len(files[index][0])
+        if batch and (len(batch) == BATCH_SIZE or batch_chars + chars > BATCH_BUDGET_CHARS):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(index)
+        batch_chars += chars
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _build_batch_prompt(files):
+    """Builds one Gemini prompt asking for an explanation of every file."""
+    parts = [BATCH_PROMPT_PREFIX]
+    for file_content, file_path in files:
+        parts.append(f"\n    ===FILE: {file_path}===\n    ```\n    ")
+        parts.append(file_content)
+        parts.append("\n    ```\n")
+    parts.append(BATCH_PROMPT_SUFFIX)
+    return "".join(parts)
+
+
+def _split_batch_response(text, files):
+    """
+    Splits a batched reply into titled per-file explanations, matched to
+    the files by the path in each section's marker. Returns None unless
+    every file has exactly one section and there are no other sections.
+    """
+    pieces = BATCH_SECTION_RE.split(text)
+    # pieces is [preamble, path, body, path, body, ...]
+    sections = {}
+    for path, body in zip(pieces[1::2], pieces[2::2]):
+        path = path.strip().strip('`')
+        if path in sections:
+            log.warning("Batch reply has more than one section for %s.", path)
+            return None
+        sections[path] = body.strip()
+
+    expected = [file_path for _, file_path in files]
+    if set(sections) != set(expected) or not all(sections.values()):
+        log.warning("Batch reply sections don't match the files sent (expected %s, got %s).",
+                    len(expected), len(sections))
+        return None
+    return [
+        f"# Explanation for `{os.path.basename(file_path)}`\n\n" + sections[file_path]
+        for file_path in expected
+    ]
+
+
+def placeholder_explanation(file_path):
+    """The document written for a file when the AI is unavailable."""
+    return _error_document(os.path.basename(file_path), _Stub.text)
+
+
+def _error_document(filename, error):
+    """Markdown describing a failed AI call."""
+    return f"# Error Analyzing `{filename}`\n\nAn error occurred while communicating with the AI model: {error}"
+
+
+async def generate_all(files, on_explained=None):
+    """
+    Generates explanations for a list of (file_content, file_path) tuples
+    concurrently. Results are returned in the same order as the input.
+    If on_explained is given, it is called with (index, explanation) as
+    soon as each file is done, so the caller can store results early.
+    """
+    semaphore = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "16")))
+
+    # Small files without a cached explanation are grouped into batches;
+    # everything else gets its own request.
+    small = [
+        index for index, (file_content, file_path) in enumerate(files)
+        if len(file_content) < BATCH_MAX_CHARS
+        and _cache_get(_build_file_prompt(file_content, file_path)) is None
+    ]
+    batches = [batch for batch in _pack_batches(small, files) if len(batch) > 1]
+    batched = {index for batch in batches for index in batch}
+
+    async def explain(group):
+        try:
+            if len(group) > 1:
+                explanations = await generate_batch_explanations_async(
+                    [files[index] for index in group], semaphore)
+            else:
+                file_content, file_path = files[group[0]]
+                explanations = [await generate_file_explanation_async(file_content, file_path, semaphore)]
+        except Exception as e:
+            explanations = [_error_document(os.path.basename(files[index][1]), e) for index in group]
+        if on_explained:
+            for index, explanation in zip(group, explanations):
+                on_explained(index, explanation)
+        return explanations
+
+    groups = [[index] for index in range(len(files)) if index not in batched] + batches
+    results = await asyncio.gather(*(explain(group) for group in groups))
+
+    explanations = [None] * len(files)
+    for group, result in zip(groups, results):
+        for index, explanation in zip(group, result):
+            explanations[index] = explanation
+    return explanations
+
+
+# The async Gemini client is cached process-wide and its gRPC channel is
+# bound to the event loop it was first used on, so every job runs its
+# coroutines on this one long-lived loop rather than a loop of its own.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _ai_loop():
+    """Returns the shared AI event loop, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="ai-loop", daemon=True).start()
+    return _loop
+
+
+def generate_all_explanations(files, on_explained=None):
+    """
+    Synchronous entry point for generate_all, for use from the background
+    job threads. The work runs on the shared AI loop; on_explained is
+    called back on the calling thread, so jobs never block that loop.
+    """
+    results = queue.Queue()
+    done = object()
+    future = asyncio.run_coroutine_threadsafe(
+        generate_all(files, lambda index, explanation: results.put((index, explanation))),
+        _ai_loop(),
+    )
+    future.add_done_callback(lambda _: results.put(done))
+    for index, explanation in iter(results.get, done):
+        if on_explained:
+            on_explained(index, explanation)
+    explanations = future.result()
+    _prune_cache()
+    return explanations
+
+
+def _build_file_prompt(file_content, file_path):
+    """Builds the Gemini prompt used to explain a single file."""
+    if len(file_content) > MAX_CONTENT_CHARS:
+        file_content = file_content[:MAX_CONTENT_CHARS] + TRUNCATION_MARKER
+    return "".join((FILE_PROMPT_PREFIX, file_path, FILE_PROMPT_MID, file_content, FILE_PROMPT_SUFFIX))
 
 
 def generate_project_overview(file_tree_str, individual_summaries):
@@ -88,7 +499,7 @@ def generate_project_overview(file_tree_str, individual_summaries):
     Analyzes the entire project structure and file summaries to generate a
     high-level overview.
     """
-    print("REAL AI: Generating project overview...")
+    log.info("REAL AI: Generating project overview...")
 
     # Convert the summaries dictionary into a more readable string format
     summaries_text = "\n".join(
@@ -138,8 +549,8 @@ def generate_project_overview(file_tree_str, individual_summaries):
     Your tone should be authoritative, clear, and helpful.
     """
     try:
-        response = model.generate_content(prompt)
+        response = _generate_content(prompt)
         return response.text
     except Exception as e:
-        print(f"Error generating project overview: {e}")
+        log.error("Error generating project overview: %s", e)
         return f"# Error Generating Project Overview\n\nAn error occurred while communicating with the AI model: {e}"
\ No newline at end of file
@@ -1,13 +1,32 @@
+import hashlib
+import json
+import logging
 import os
+import queue
+import re
+import time
 import uuid
 import threading
-from flask import Flask, request, redirect, url_for, jsonify, render_template, send_from_directory
-from flask import after_this_request
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask, Response, abort, request, redirect, url_for, jsonify, render_template, send_file
 import shutil
 import platform
-import subprocess
+import stat
 from google.cloud import datastore
 
+# --- Logging ---
+# Worker threads only put records on a queue; a single background listener
+# does the actual (slow, serialized) writing to stderr. This is set up before
+# importing the engine so its startup messages go through it too.
+log_queue = queue.Queue(-1)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+
+log = logging.getLogger(__name__)
+
 # --- This is the crucial import from your own work ---
 from engine import run_analysis_job
 
@@ -18,6 +37,123 @@ app = Flask(__name__)
 # This will use the project defined in your GOOGLE_CLOUD_PROJECT environment variable
 datastore_client = datastore.Client()
 
+# A single process-wide pool runs the analysis jobs. This bounds how many
+# jobs (and therefore Gemini fan-outs) can run at once; extra jobs queue up.
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("JOB_WORKERS", "4")))
+
+# A finished job's zip is kept this long, so interrupted downloads can be
+# resumed and repeat downloads revalidated, and is then cleaned up.
+DOWNLOAD_TTL_SECONDS = int(os.getenv("DOWNLOAD_TTL_SECONDS", "3600"))
+
+# How long one status stream may stay open before the browser reconnects
+STREAM_MAX_SECONDS = int(os.getenv("STREAM_MAX_SECONDS", "30"))
+
+# The job fields the browser is allowed to see; the rest (zip_path, etag)
+# are server-side bookkeeping.
+PUBLIC_JOB_FIELDS = ('status', 'download_url', 'error_message')
+
+# A job in one of these states won't change again
+FINAL_STATUSES = ('COMPLETE', 'FAILED')
+
+# Download filenames look like 'documentation_<32 hex digit job id>.zip'
+_JOB_RE = re.compile(r"documentation_([0-9a-f]{32})\.zip")
+
+
+class JobStore:
+    """
+    Thread-safe job state, kept in memory and written through to Datastore.
+    Reads are served from memory, so status polls don't cost a Datastore
+    round-trip. Updates are flushed to Datastore in the background, in order,
+    so they never block the job thread either.
+    """
+
+    def __init__(self, client, kind='Job'):
+        self._lock = threading.Lock()
+        # Notified on every update, so status streams can wake up immediately.
+        self._changed = threading.Condition(self._lock)
+        self._mem = {}
+        self._versions = {}
+        self._ds = client
+        self._kind = kind
+        # A single worker keeps the flushes for a job in submission order.
+        self._flusher = ThreadPoolExecutor(max_workers=1)
+
+    def create(self, job_id, **fields):
+        """
+        Records a new job. Unlike update, this writes to Datastore before
+        returning, because the status page may be served by another
+        process that can only find the job there.
+        """
+        with self._lock:
+            self._mem[job_id] = dict(fields)
+            self._versions[job_id] = 1
+            snapshot = dict(fields)
+        self._flush(job_id, snapshot)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._mem.setdefault(job_id, {})
+            job.update(fields)
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            snapshot = dict(job)
+            self._changed.notify_all()
+        # Once a job has finished, Datastore is enough to answer for it, so it
+        # is dropped from memory after its final state has been saved.
+        final = snapshot.get('status') in FINAL_STATUSES
+        self._flusher.submit(self._flush, job_id, snapshot, final)
+
+    def get(self, job_id):
+        """
+        Returns a copy of the job's state, or None if it doesn't exist.
+        Jobs started by another instance are only in Datastore, so those are
+        looked up there (and not cached, since this instance won't see their
+        updates).
+        """
+        with self._lock:
+            job = self._mem.get(job_id)
+            if job is not None:
+                return dict(job)
+        entity = self._ds.get(self._ds.key(self._kind, job_id))
+        return dict(entity) if entity else None
+
+    def wait_for_update(self, job_id, version, timeout):
+        """
+        Blocks until the job has changed since `version` (or until timeout),
+        then returns (job, version). Pass None on the first call. Jobs that
+        aren't held in memory are re-read from Datastore after the timeout.
+        """
+        with self._changed:
+            if job_id in self._mem:
+                self._changed.wait_for(
+                    lambda: self._versions.get(job_id) != version, timeout)
+                job = self._mem.get(job_id)
+                if job is not None:
+                    return dict(job), self._versions[job_id]
+            elif version is not None:
+                self._changed.wait(timeout)
+        return self.get(job_id), 0
+
+    def discard(self, job_id):
+        """Drops a finished job from memory; Datastore still has its final state."""
+        with self._lock:
+            self._mem.pop(job_id, None)
+            self._versions.pop(job_id, None)
+
+    def _flush(self, job_id, snapshot, discard=False):
+        try:
+            entity = datastore.Entity(key=self._ds.key(self._kind, job_id))
+            entity.update(snapshot)
+            self._ds.put(entity)
+        except Exception as e:
+            # Keep the job in memory, since Datastore doesn't have it
+            log.warning("Could not save job %s to Datastore: %s", job_id, e)
+            return
+        if discard:
+            self.discard(job_id)
+
+
+job_store = JobStore(datastore_client)
+
 
 @app.route("/")
 def index():
@@ -37,72 +173,103 @@ def generate():
     if not repo_url:
         return "URL is required", 400
 
-    job_id = str(uuid.uuid4())
+    job_id = uuid.uuid4().hex
 
-    # --- Create a record in Datastore to track the job ---
-    kind = 'Job'
-    key = datastore_client.key(kind, job_id)
-    job_entity = datastore.Entity(key=key)
-    job_entity.update({
-        'status': 'PENDING',
-        'download_url': None,
-        'error_message': None
-    })
-    datastore_client.put(job_entity)
+    # --- Create a record to track the job ---
+    job_store.create(job_id, status='PENDING', download_url=None, error_message=None)
 
     # --- This is where we start the background job ---
     # We pass the job_id and repo_url to our target function.
-    thread = threading.Thread(target=run_analysis_job_wrapper, args=(job_id, repo_url))
-    thread.start()
+    EXECUTOR.submit(run_analysis_job_wrapper, job_id, repo_url)
 
     # Immediately redirect the user so their browser doesn't wait and time out
     return redirect(url_for('status', job_id=job_id))
 
 
-def cleanup_job_files(job_id):
+def _fast_rmtree(path):
+    """
+    Removes a directory tree. A cloned repo is mostly thousands of tiny
+    .git objects, so on POSIX the unlinks within each directory are spread
+    over a thread pool instead of being issued one at a time.
+    """
+    if platform.system() == "Windows":
+        _win_rmtree(path)
+        return
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for root, dirs, files in os.walk(path, topdown=False):
+            # Symlinked directories show up in dirs but are removed like files
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            list(executor.map(os.unlink, [os.path.join(root, name) for name in files + links]))
+            os.rmdir(root)
+
+
+def _win_rmtree(path):
+    """
+    Removes a directory tree on Windows. shutil.rmtree struggles with .git
+    directories because git marks its object files read-only, so the
+    read-only flag is cleared before each file is deleted.
+    """
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_path = os.path.join(root, name)
+            os.chmod(file_path, stat.S_IWRITE)
+            os.unlink(file_path)
+        for name in dirs:
+            # Symlinked directories are not descended into by os.walk
+            dir_path = os.path.join(root, name)
+            if os.path.islink(dir_path):
+                os.unlink(dir_path)
+        os.rmdir(root)
+
+
+def cleanup_job_files(job_id, zip_path):
     """
     Safely removes all temporary files and the final zip for a given job.
-    Uses platform-specific commands for robustness on Windows.
+    Uses a Windows-specific removal for robustness with .git directories.
     """
-    print(f"Cleaning up files for completed job: {job_id}")
+    log.info("Cleaning up files for completed job: %s", job_id)
+    job_store.discard(job_id)
 
-    # Use absolute paths to prevent ambiguity
-    current_directory = os.path.abspath('.')
-    repo_path = os.path.join(current_directory, f"temp_repo_{job_id}")
-    output_path = os.path.join(current_directory, f"output_repo_{job_id}")
-    zip_filename = os.path.join(current_directory, f"documentation_{job_id}.zip")
+    # The engine removes its clone as soon as the zip is written, so this only
+    # catches one left behind (e.g. by a crash). It sits next to the zip.
+    repo_path = os.path.join(os.path.dirname(zip_path), f"temp_repo_{job_id}")
 
     # --- Robust directory removal ---
     if os.path.exists(repo_path):
-        print(f"Attempting to remove temp repo: {repo_path}")
+        log.info("Attempting to remove temp repo: %s", repo_path)
         try:
-            if platform.system() == "Windows":
-                # On Windows, shutil.rmtree can struggle with .git directories.
-                # The native 'rmdir' command is more reliable.
-                # /s is for recursive, /q is for quiet mode.
-                subprocess.run(f'rmdir /s /q "{repo_path}"', shell=True, check=True)
-                print(f"Successfully removed temp repo: {repo_path}")
-            else:
-                # For other OSes, shutil.rmtree is generally fine.
-                shutil.rmtree(repo_path)
-                print(f"Successfully removed temp repo: {repo_path}")
-        except (subprocess.CalledProcessError, OSError) as e:
-            # If even the native commands fail, log the error.
-            print(f"ERROR: Failed to remove directory {repo_path}. Error: {e}")
+            _fast_rmtree(repo_path)
+            log.info("Successfully removed temp repo: %s", repo_path)
+        except OSError as e:
+            # If the removal fails, log the error.
+            log.error("Failed to remove directory %s. Error: %s", repo_path, e)
             # As a last resort, try the less reliable method which might clean some files.
             shutil.rmtree(repo_path, ignore_errors=True)
 
-    # Clean up other generated files, which are less likely to have lock issues.
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path, ignore_errors=True)
-        print(f"Removed output repo: {output_path}")
-
-    if os.path.exists(zip_filename):
+    # Clean up the zip, which is less likely to have lock issues.
+    if os.path.exists(zip_path):
         try:
-            os.remove(zip_filename)
-            print(f"Removed zip file: {zip_filename}")
+            os.remove(zip_path)
+            log.info("Removed zip file: %s", zip_path)
         except OSError as e:
-            print(f"Warning: Could not remove zip file {zip_filename}: {e}")
+            log.warning("Could not remove zip file %s: %s", zip_path, e)
+
+
+def schedule_cleanup(job_id, zip_path):
+    """Cleans up a finished job's files once DOWNLOAD_TTL_SECONDS have passed."""
+    timer = threading.Timer(DOWNLOAD_TTL_SECONDS, cleanup_job_files, args=(job_id, zip_path))
+    timer.daemon = True
+    timer.start()
+
+
+def _file_etag(path):
+    """Returns a content hash of a file, for use as its HTTP ETag."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 def run_analysis_job_wrapper(job_id, repo_url):
@@ -110,13 +277,9 @@ def run_analysis_job_wrapper(job_id, repo_url):
     A wrapper function that runs our main job and updates the status.
     This is what the background thread will execute.
     """
-    # --- Update status in Datastore ---
-    key = datastore_client.key('Job', job_id)
-    job_entity = datastore_client.get(key)
-    job_entity['status'] = 'PROCESSING'
-    datastore_client.put(job_entity)
-    
-    print(f"Starting job {job_id} for URL: {repo_url}")
+    job_store.update(job_id, status='PROCESSING')
+
+    log.info("Starting job %s for URL: %s", job_id, repo_url)
     
     try:
         # --- This calls your tested engine code ---
@@ -125,24 +288,28 @@ def run_analysis_job_wrapper(job_id, repo_url):
         
         if zip_file_path:
             # Job succeeded
-            job_entity['status'] = 'COMPLETE'
-            # Create a URL the user can use to download the file
-            job_entity['download_url'] = f"/download/{os.path.basename(zip_file_path)}"
-            print(f"Job {job_id} completed successfully.")
+            # Create a URL the user can use to download the file. The ETag is
+            # computed once here so downloads can be revalidated and resumed.
+            job_store.update(job_id, status='COMPLETE',
+                             download_url=f"/download/{os.path.basename(zip_file_path)}",
+                             zip_path=zip_file_path, etag=_file_etag(zip_file_path))
+            schedule_cleanup(job_id, zip_file_path)
+            log.info("Job %s completed successfully.", job_id)
         else:
             # Job failed gracefully (e.g., no files found)
-            job_entity['status'] = 'FAILED'
-            job_entity['error_message'] = 'No suitable files were found to analyze in the repository.'
-            print(f"Job {job_id} failed: No files to analyze.")
+            job_store.update(job_id, status='FAILED',
+                             error_message='No suitable files were found to analyze in the repository.')
+            log.warning("Job %s failed: No files to analyze.", job_id)
 
     except Exception as e:
         # Job failed with an unexpected error
-        print(f"Job {job_id} failed with an error: {e}")
-        job_entity['status'] = 'FAILED'
-        job_entity['error_message'] = str(e)
-    
-    # --- Final update to Datastore ---
-    datastore_client.put(job_entity)
+        log.error("Job %s failed with an error: %s", job_id, e)
+        job_store.update(job_id, status='FAILED', error_message=str(e))
+
+
+def public_job(job):
+    """The part of a job record that is sent to the browser."""
+    return {field: job.get(field) for field in PUBLIC_JOB_FIELDS}
 
 
 @app.route("/status/<job_id>")
@@ -152,39 +319,69 @@ def status(job_id):
 # --- This is the API endpoint that Person B's JavaScript will call ---
 @app.route("/api/status/<job_id>")
 def api_status(job_id):
-    """Provides the status of a job in JSON format from Datastore."""
-    key = datastore_client.key('Job', job_id)
-    job_entity = datastore_client.get(key)
+    """Provides the status of a job in JSON format."""
+    job = job_store.get(job_id)
     
-    if not job_entity:
+    if not job:
         return jsonify({'status': 'NOT_FOUND'}), 404
     
-    # The entity itself is a dict-like object, perfect for jsonify
-    return jsonify(job_entity)
+    return jsonify(public_job(job))
+
+
+@app.route("/api/stream/<job_id>")
+def api_stream(job_id):
+    """Pushes the status of a job to the browser as Server-Sent Events."""
+    # X-Accel-Buffering stops the App Engine nginx proxy from holding events back
+    return Response(event_stream(job_id), mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def event_stream(job_id):
+    """
+    Yields an SSE message every time the job changes, until it finishes.
+    A keep-alive comment is sent when nothing has changed for a while.
+    Each open stream holds a server thread, so a stream is closed after
+    STREAM_MAX_SECONDS; the browser's EventSource then reconnects and
+    picks up the current status.
+    """
+    version = None
+    last_sent = None
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    # Ask EventSource to reconnect after a second rather than its default
+    yield "retry: 1000\n\n"
+    while time.monotonic() < deadline:
+        job, version = job_store.wait_for_update(job_id, version, timeout=3)
+        if not job:
+            yield f"data: {json.dumps({'status': 'NOT_FOUND'})}\n\n"
+            return
+        job = public_job(job)
+        if job == last_sent:
+            yield ": keep-alive\n\n"
+            continue
+        last_sent = job
+        yield f"data: {json.dumps(job)}\n\n"
+        if job.get('status') in FINAL_STATUSES:
+            return
 
 
 @app.route("/download/<filename>")
 def download(filename):
-    """Serves the generated zip file and then triggers cleanup."""
-    # We must extract the job_id from the filename to know what to clean up.
-    # Assumes filename format is 'documentation_some-uuid-string.zip'
-    try:
-        job_id = filename.split('_')[1].replace('.zip', '')
-
-        # This is a special Flask decorator that schedules a function
-        # to run AFTER the current request has been fully sent to the user.
-        @after_this_request
-        def trigger_cleanup(response):
-            # The background thread will run this function after the download is complete
-            cleanup_thread = threading.Thread(target=cleanup_job_files, args=(job_id,))
-            cleanup_thread.start()
-            return response
-
-    except IndexError:
-        print(f"Warning: Could not parse job_id from filename {filename} for cleanup.")
-        pass
-
-    print(f"Serving file: {filename}")
-    # Use the absolute path for robustness
-    directory = os.path.abspath('.')
-    return send_from_directory(directory, filename, as_attachment=True)
\ No newline at end of file
+    """Serves the generated zip file. It is cleaned up later by schedule_cleanup."""
+    # We must extract the job_id from the filename to find the job.
+    # Anything that isn't exactly one of our zip names is rejected outright.
+    m = _JOB_RE.fullmatch(filename)
+    if not m:
+        abort(404)
+    job_id = m.group(1)
+
+    # Serve the zip the job recorded, rather than rebuilding its path here
+    job = job_store.get(job_id)
+    path = job.get('zip_path') if job else None
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    log.info("Serving file: %s", filename)
+    # With conditional=True, Flask answers If-None-Match with a 304 and
+    # Range requests with partial content, so repeat downloads are cheap.
+    return send_file(path, as_attachment=True, download_name=filename,
+                     etag=job.get('etag') or True, conditional=True, max_age=0)
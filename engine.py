@@ -1,24 +1,84 @@
+import collections
 import fnmatch
+import functools
 import git
+import hashlib
+import logging
+import mmap
 import os
+import re
 import shutil
 import stat
+import sys
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-from ai_content import generate_file_explanation, generate_project_overview
+from ai_content import (
+    AI_AVAILABLE, MAX_CONTENT_CHARS, generate_all_explanations, generate_project_overview,
+    placeholder_explanation,
+)
 
+log = logging.getLogger(__name__)
 
-def create_file_tree_string(start_path):
-    """Generates a string representation of a directory tree."""
-    tree_string = ""
-    for root, dirs, files in os.walk(start_path):
-        # We don't want to show the full path, but the path relative to the start
-        level = root.replace(start_path, '').count(os.sep)
-        indent = ' ' * 4 * level
-        tree_string += f"{indent}{os.path.basename(root)}/\n"
+
+def create_file_tree_string(relative_paths, root_name):
+    """
+    Generates a string representation of a directory tree from a list of
+    file paths relative to its root.
+    """
+    # Each directory is a (subdirectories, files) pair
+    root = ({}, [])
+    for path in sorted(relative_paths):
+        subdirs, files = root
+        *dir_names, filename = path.split(os.sep)
+        for name in dir_names:
+            subdirs, files = subdirs.setdefault(name, ({}, []))
+        files.append(filename)
+
+    lines = []
+
+    def add_directory(name, directory, level):
+        subdirs, files = directory
+        lines.append(f"{' ' * 4 * level}{name}/\n")
         sub_indent = ' ' * 4 * (level + 1)
-        for f in files:
-            tree_string += f"{sub_indent}{f}\n"
-    return tree_string
+        lines.extend(f"{sub_indent}{f}\n" for f in files)
+        for sub_name, subdir in subdirs.items():
+            add_directory(sub_name, subdir, level + 1)
+
+    add_directory(root_name, root, 0)
+    return "".join(lines)
+
+
+def markdown_names(relative_paths, reserved=()):
+    """
+    Maps each file path to the name of its Markdown document in the zip.
+    A file normally gets its path with the extension swapped for .md, but
+    files sharing a stem (pkg/b.py and pkg/b.js) keep their extension
+    (pkg/b.py.md) so no two documents get the same name.
+    """
+    stem_counts = collections.Counter(os.path.splitext(path)[0] for path in relative_paths)
+    taken = set(reserved)
+    names = {}
+    for path in sorted(relative_paths):
+        stem = os.path.splitext(path)[0]
+        base = stem if stem_counts[stem] == 1 else path
+        name, suffix = base + ".md", 2
+        while name in taken:
+            name = f"{base}~{suffix}.md"
+            suffix += 1
+        taken.add(name)
+        names[path] = name
+    return names
+
+
+@functools.lru_cache(maxsize=None)
+def git_supports_partial_clone():
+    """Partial clone (--filter) needs git 2.19 or newer."""
+    try:
+        return git.Git().version_info >= (2, 19)
+    except git.exc.GitCommandError:
+        return False
 
 
 def clone_repo(url, dest_path):
@@ -27,97 +87,172 @@ def clone_repo(url, dest_path):
     Cleans up the destination path if it already exists.
     """
     if os.path.exists(dest_path):
-        print(f"Cleaning up old directory: {dest_path}")
+        log.info("Cleaning up old directory: %s", dest_path)
         # Use the robust on_rm_error for cleanup here as well
         shutil.rmtree(dest_path, onerror=on_rm_error)
     
-    print(f"Cloning {url} into {dest_path}...")
+    log.info("Cloning %s into %s...", url, dest_path)
     try:
-        repo = git.Repo.clone_from(url, dest_path, depth=1)
-        print("Cloning complete.")
+        options = ["--depth=1", "--single-branch", "--no-tags"]
+        if git_supports_partial_clone():
+            # Blobless clone: commits and trees come down first, blobs on checkout
+            options.insert(0, "--filter=blob:none")
+        repo = git.Repo.clone_from(url, dest_path, multi_options=options)
+        log.info("Cloning complete.")
         return repo
     except git.exc.GitCommandError as e:
-        print(f"Error cloning repo: {e}")
+        log.error("Error cloning repo: %s", e)
         raise  # Re-raise the exception to be handled by the caller
 
 
-def should_ignore_dir(dirname, ignored_dirs):
-    if dirname in ignored_dirs:
-        return True
-    return any(fnmatch.fnmatch(dirname, pattern) for pattern in ignored_dirs if '*' in pattern)
+# These configurations can be tuned
+IGNORED_DIRS = [
+    '.git', 'node_modules', 'venv', '__pycache__', 'dist', 'build', 
+    '.idea', '.vscode', 'target', 'logs', 'docs', '*.egg-info'
+]
+IGNORED_EXTS = [
+    '.lock', '.log', '.svg', '.png', '.jpg', '.ico', '.gif', '.pdf', '.zip',
+    '.exe', '.dll', '.so', '.pyc', '.env', '.db', '.safetensors', '.pt'
+]
+IGNORED_FILENAMES = [
+    '__init__.py', 'setup.py', 'manage.py', 'config.py',
+    'requirements.txt', 'package.json', 'Dockerfile', '.gitignore', 'LICENSE'
+]
+MAX_FILE_SIZE_KB = 100
+
+# The rules above, compiled once so each check is a set lookup or one regex match
+IGNORED_EXT_SET = frozenset(IGNORED_EXTS)
+# Ignored filenames, hidden files and test files, as a single alternation.
+# Hidden files are matched by the leading dot, which covers .gitignore too.
+IGNORED_NAME_RE = re.compile('|'.join(
+    [re.escape(name) for name in IGNORED_FILENAMES] + [r'\..*', r'test_.*', r'.*_test\.py']
+), re.DOTALL)
+IGNORED_DIR_SET = frozenset(d for d in IGNORED_DIRS if '*' not in d)
+IGNORED_DIR_RE = re.compile('|'.join(fnmatch.translate(p) for p in IGNORED_DIRS if '*' in p) or r'(?!)')
+
+
+def should_ignore_dir(dirname):
+    return dirname in IGNORED_DIR_SET or IGNORED_DIR_RE.match(dirname) is not None
+
+
+# Bytes that commonly appear in text files: printable ASCII and everything
+# above it, plus the usual control characters (BEL, BS, TAB, LF, FF, CR, ESC)
+TEXTCHARS = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+
+# Extensions that are always source or text, so there is no need to sniff them
+KNOWN_TEXT_EXTS = frozenset({
+    '.py', '.js', '.ts', '.tsx', '.jsx', '.go', '.rs', '.c', '.cc', '.cpp', '.h', '.hpp',
+    '.java', '.kt', '.rb', '.php', '.cs', '.swift', '.md', '.rst', '.txt', '.toml',
+    '.json', '.xml', '.html', '.css', '.scss', '.sh', '.bash', '.zsh', '.sql', '.r',
+})
+
+
+@functools.lru_cache(maxsize=None)
+def classify_extension(ext):
+    """
+    Decides, once per distinct extension, whether its files are skipped
+    ('ignore'), known to be text ('text'), or need sniffing ('sniff').
+    """
+    if ext in IGNORED_EXT_SET:
+        return 'ignore'
+    if ext.lower() in KNOWN_TEXT_EXTS:
+        return 'text'
+    return 'sniff'
 
 
 def is_text_file(filepath):
     try:
         with open(filepath, 'rb') as f:
             chunk = f.read(1024)
-            if b'\x00' in chunk:
-                return False
-            # Try to decode a chunk of the file to see if it's text
-            chunk.decode('utf-8')
-        return True
-    except (UnicodeDecodeError, IOError):
+        if b'\x00' in chunk:
+            return False
+        # Same heuristic as file(1): a text file has few bytes outside TEXTCHARS.
+        # translate() strips the text bytes in C, leaving only the suspicious ones.
+        nontext = len(chunk.translate(None, TEXTCHARS))
+        return nontext / max(len(chunk), 1) < 0.30
+    except IOError:
         return False
 
 
-def get_code_files(repo_path):
-    code_files = []
-    
-    # These configurations can be tuned
-    ignored_dirs = [
-        '.git', 'node_modules', 'venv', '__pycache__', 'dist', 'build', 
-        '.idea', '.vscode', 'target', 'logs', 'docs', '*.egg-info'
-    ]
-    ignored_exts = [
-        '.lock', '.log', '.svg', '.png', '.jpg', '.ico', '.gif', '.pdf', '.zip',
-        '.exe', '.dll', '.so', '.pyc', '.env', '.db', '.safetensors', '.pt'
-    ]
-    ignored_filenames = [
-        '__init__.py', 'setup.py', 'manage.py', 'config.py',
-        'requirements.txt', 'package.json', 'Dockerfile', '.gitignore', 'LICENSE'
-    ]
-    max_file_size_kb = 100
-
-    print("Scanning for code files to analyze...")
-    # Ensure the path exists before walking
-    if not os.path.isdir(repo_path):
-        print(f"Warning: Directory not found at {repo_path}, cannot scan for files.")
-        return []
-
-    for root, dirs, files in os.walk(repo_path, followlinks=False):
-        # Filter out ignored directories in-place
-        dirs[:] = [d for d in dirs if not should_ignore_dir(d, ignored_dirs)]
-
-        for file in files:
-            # Skip files based on various ignore criteria
-            if file in ignored_filenames or (file.startswith('.') and file not in ['.gitignore']):
-                continue
-            if file.startswith('test_') or file.endswith('_test.py'):
-                continue
-            if any(file.endswith(ext) for ext in ignored_exts):
+def scan_files(path):
+    """
+    Recursively yields a DirEntry for every non-directory under path,
+    skipping ignored directories. Symlinks are yielded, never followed.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not should_ignore_dir(entry.name):
+                subdirs.append(entry.path)
+        else:
+            yield entry
+    for subdir in subdirs:
+        yield from scan_files(subdir)
+
+
+def iter_code_files(repo_path):
+    """
+    Yields the path of each file under repo_path worth analyzing, as soon
+    as the scan reaches it, so the caller can start reading right away.
+    """
+    for entry in scan_files(repo_path):
+        file = entry.name
+        # Skip files based on various ignore criteria
+        if IGNORED_NAME_RE.fullmatch(file):
+            continue
+        ext_rule = classify_extension(os.path.splitext(file)[1])
+        if ext_rule == 'ignore':
+            continue
+        
+        # Make sure we don't follow symbolic links
+        if entry.is_symlink():
+            continue
+
+        try:
+            # Check file size and whether it's a binary file.
+            # is_symlink() above came free with the directory listing, and
+            # this single lstat replaces the old islink + getsize pair.
+            if entry.stat(follow_symlinks=False).st_size > MAX_FILE_SIZE_KB * 1024:
+                log.info("Skipping large file: %s", file)
                 continue
-            
-            file_path = os.path.join(root, file)
-            # Make sure we don't follow symbolic links
-            if os.path.islink(file_path):
+            if ext_rule == 'sniff' and not is_text_file(entry.path):
+                log.info("Skipping binary file: %s", file)
                 continue
+        except OSError:
+            # This can happen if the file is deleted during the scan
+            continue
 
-            try:
-                # Check file size and whether it's a binary file
-                if os.path.getsize(file_path) > max_file_size_kb * 1024:
-                    print(f"Skipping large file: {os.path.basename(file_path)}")
-                    continue
-                if not is_text_file(file_path):
-                    print(f"Skipping binary file: {os.path.basename(file_path)}")
-                    continue
-            except OSError:
-                # This can happen if the file is deleted during the scan
-                continue
+        yield entry.path
+
+
+def read_file_for_analysis(file_path):
+    """
+    Reads a file for the AI and hashes its content.
+    Returns (file_path, content, content_hash), or None if it can't be read.
+    """
+    try:
+        # The file is memory-mapped and hashed and decoded straight from the
+        # mapping, so its bytes are never copied into a buffer of their own.
+        # They are hashed raw, so the text never has to be encoded again.
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # An empty file can't be mapped
+                content, content_hash = '', hashlib.sha256(b'').hexdigest()
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    content_hash = hashlib.sha256(data).hexdigest()
+                    # Anything past the prompt limit would be truncated anyway
+                    content = str(data, 'utf-8', 'ignore')[:MAX_CONTENT_CHARS + 1]
+    except Exception as e:
+        log.warning("Could not read file %s: %s", file_path, e)
+        return None
+    return file_path, content, content_hash
 
-            code_files.append(file_path)
-            
-    print(f"Found {len(code_files)} files to analyze.")
-    return code_files
 
 def on_rm_error(func, path, exc_info):
     """
@@ -134,6 +269,17 @@ def on_rm_error(func, path, exc_info):
         raise
 
 
+def remove_clone(repo_path):
+    """Removes a cloned repo, logging rather than raising if that fails."""
+    try:
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(repo_path, onexc=on_rm_error)
+        else:
+            shutil.rmtree(repo_path, onerror=on_rm_error)
+    except OSError as e:
+        log.warning("Could not remove cloned repo %s: %s", repo_path, e)
+
+
 def run_analysis_job(repo_url, job_id):
     """
     The main orchestrator function.
@@ -144,68 +290,93 @@ def run_analysis_job(repo_url, job_id):
     # App Engine has a read-only filesystem, except for the /tmp directory.
     base_path = "/tmp"
     repo_path = os.path.join(base_path, f"temp_repo_{job_id}")
-    output_path = os.path.join(base_path, f"output_repo_{job_id}")
-    zip_filename_base = f"documentation_{job_id}"
-    zip_path_base = os.path.join(base_path, zip_filename_base)
+    zip_path = os.path.join(base_path, f"documentation_{job_id}.zip")
+    repo_name = os.path.splitext(os.path.basename(repo_url.rstrip('/')))[0]
 
     repo = None
     try:
         # Phase 1: Clone & Filter
         repo = clone_repo(repo_url, repo_path)
-        files_to_analyze = get_code_files(repo_path)
-        
-        if not files_to_analyze:
-            print("No suitable files found to analyze.")
-            return None
 
         # Phase 2: Process each file and generate explanations
-        if os.path.exists(output_path):
-            shutil.rmtree(output_path, onerror=on_rm_error)
-        os.makedirs(output_path, exist_ok=True)
+        # Files stream from the scan into the read pool. Identical files with
+        # the same name are grouped so the AI is asked about each only once,
+        # and paths are kept repo-relative so cache keys are stable across jobs.
+        log.info("Scanning for code files to analyze...")
+        repo_prefix_len = len(os.path.join(repo_path, ''))
+        file_count = 0
+        groups = {}
+        with ThreadPoolExecutor(max_workers=int(os.environ.get("READ_WORKERS", 16))) as executor:
+            for result in executor.map(read_file_for_analysis, iter_code_files(repo_path)):
+                if result is None:
+                    continue
+                file_path, content, content_hash = result
+                file_count += 1
+                relative_path = file_path[repo_prefix_len:]
+                group_key = (content_hash, os.path.basename(relative_path))
+                groups.setdefault(group_key, (content, []))[1].append(relative_path)
+        groups = list(groups.values())
+        log.info("Found %s files to analyze.", file_count)
+
+        if not groups:
+            log.info("No suitable files found to analyze.")
+            return None
+
+        duplicates = file_count - len(groups)
+        if duplicates:
+            log.info("Skipping %s duplicate files.", duplicates)
 
+        # The Markdown goes straight into the zip as each explanation comes
+        # back, so there is no intermediate output folder to write and re-read.
+        # The zip is a throwaway download, so the fastest deflate level is used:
+        # several times less CPU than the default for a slightly larger file.
         individual_summaries = {}
-        for file_path in files_to_analyze:
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-            except Exception as e:
-                print(f"Could not read file {file_path}: {e}")
-                continue
-            
-            explanation = generate_file_explanation(content, file_path)
-            
-            relative_path = os.path.relpath(file_path, repo_path)
-            output_file_path = os.path.join(output_path, relative_path)
-            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-            
-            base, _ = os.path.splitext(output_file_path)
-            with open(base + ".md", 'w', encoding='utf-8') as f:
-                f.write(explanation)
-            
-            first_line = explanation.split('\n')[0]
-            individual_summaries[relative_path] = first_line
-
-        # Phase 3: Generate the final project overview
-        print("Generating final project overview...")
-        file_tree = create_file_tree_string(output_path)
-        overview_content = generate_project_overview(file_tree, individual_summaries)
-        with open(os.path.join(output_path, "_PROJECT_OVERVIEW.md"), 'w', encoding='utf-8') as f:
-            f.write(overview_content)
-            
-        # Phase 4: Zip the final output folder
-        print("Zipping the final documentation...")
-        final_zip_path = shutil.make_archive(zip_path_base, 'zip', output_path)
-        print(f"Successfully created zip file: {final_zip_path}")
-
-        return final_zip_path
+        markdown_paths = []
+        overview_name = "_PROJECT_OVERVIEW.md"
+        names = markdown_names([path for _, paths in groups for path in paths], reserved=(overview_name,))
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+
+            def write_explanation(index, explanation):
+                _, paths = groups[index]
+                first_line = explanation.split('\n')[0]
+                for relative_path in paths:
+                    markdown_path = names[relative_path]
+                    zf.writestr(markdown_path, explanation)
+                    markdown_paths.append(markdown_path)
+                    individual_summaries[relative_path] = first_line
+
+            if AI_AVAILABLE:
+                # The AI calls are network-bound, so they are fanned out concurrently
+                generate_all_explanations(
+                    [(content, paths[0]) for content, paths in groups],
+                    on_explained=write_explanation,
+                )
+            else:
+                log.warning("Gemini AI is unavailable, writing placeholder documentation.")
+                for index, (_, paths) in enumerate(groups):
+                    write_explanation(index, placeholder_explanation(paths[0]))
+
+            # Phase 3: Generate the final project overview
+            log.info("Generating final project overview...")
+            file_tree = create_file_tree_string(markdown_paths, repo_name)
+            overview_content = generate_project_overview(file_tree, individual_summaries)
+            zf.writestr(overview_name, overview_content)
+
+        log.info("Successfully created zip file: %s", zip_path)
+        return zip_path
         
     finally:
         if repo:
             repo.close()
-            print(f"Git repo object for job {job_id} closed.")
+            log.info("Git repo object for job %s closed.", job_id)
+        # The clone isn't needed once the zip is written. Removing a .git tree
+        # is thousands of unlinks, so it happens in the background.
+        if os.path.exists(repo_path):
+            threading.Thread(target=remove_clone, args=(repo_path,), daemon=True).start()
 
 # This block allows us to test the engine directly
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     print("--- Running Engine Test ---")
     test_repo_url = "https://github.com/pallets-eco/flask-sqlalchemy"
     test_job_id = "local_test_tmp"